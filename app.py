@@ -1,6 +1,7 @@
 import os, time, asyncio
 from datetime import datetime, timezone
-from collections import deque
+from collections import deque, OrderedDict
+from io import BytesIO
 from typing import Optional
 from fastapi import FastAPI, UploadFile, File, Request, Body
 from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, Response, FileResponse
@@ -8,6 +9,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from pymongo import MongoClient
 from dotenv import load_dotenv
 import requests
+from PIL import Image
 
 # ---------- Load environment variables ----------
 load_dotenv()
@@ -45,6 +47,7 @@ app.add_middleware(
 SENSOR_HISTORY_MAX = 5000
 sensor_history = deque(maxlen=SENSOR_HISTORY_MAX)
 latest_frame_bytes: Optional[bytes] = None
+latest_frame_id: Optional[str] = None
 latest_annotated_path: Optional[str] = None
 latest_control = {"cmd": "stop", "speed": 150, "timestamp": datetime.now(timezone.utc).isoformat()}
 latest_infer = {"available": False, "timestamp": None, "boxes": [], "score": None, "fname": None}
@@ -64,6 +67,53 @@ def upload_to_imgbb(img_path, expiration=None):
     print("ImgBB upload failed:", response.text)
     return None
 
+# ------------------- Viewer Tiers -------------------
+# Longest edge in pixels / JPEG quality; "full" passes the camera JPEG through untouched
+SIZE_TIERS = {"full": None, "high": 1280, "medium": 640, "low": 320}
+QUALITY_TIERS = {"full": None, "high": 85, "medium": 70, "low": 50}
+REENCODE_QUALITY = 90  # used when only the size is reduced
+TIER_CACHE_FRAMES = 4  # recent frame ids kept in the tier cache
+tier_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+def tier_error(size, quality):
+    if size in SIZE_TIERS and quality in QUALITY_TIERS:
+        return None
+    return JSONResponse({"error": "invalid tier",
+                         "sizes": list(SIZE_TIERS),
+                         "qualities": list(QUALITY_TIERS)}, 400)
+
+def encode_tier(img_bytes, max_edge, quality):
+    img = Image.open(BytesIO(img_bytes))
+    if max_edge:
+        img.thumbnail((max_edge, max_edge))  # uses JPEG draft mode to decode at reduced scale
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    out = BytesIO()
+    img.save(out, format="JPEG", quality=quality or REENCODE_QUALITY, optimize=True)
+    return out.getvalue()
+
+async def get_tier_bytes(frame_id, load, size, quality):
+    """Return the frame encoded for a tier, encoding it at most once per frame id."""
+    max_edge, q = SIZE_TIERS[size], QUALITY_TIERS[quality]
+    if max_edge is None and q is None:
+        return load()
+    tiers = tier_cache.get(frame_id)
+    if tiers is None:
+        tiers = tier_cache[frame_id] = {}
+        while len(tier_cache) > TIER_CACHE_FRAMES:
+            tier_cache.popitem(last=False)
+    task = tiers.get((size, quality))
+    if task is None:
+        # Concurrent viewers of the same tier all await this one encode
+        task = asyncio.ensure_future(asyncio.to_thread(lambda: encode_tier(load(), max_edge, q)))
+        tiers[(size, quality)] = task
+    try:
+        # Shielded so one viewer disconnecting does not cancel the encode for the others
+        return await asyncio.shield(task)
+    except Exception as e:
+        print("Tier encode failed:", e)
+        return load()
+
 # ------------------- Sensors -------------------
 @app.post("/api/sensors")
 async def sensors_post(data: dict):
@@ -90,7 +140,7 @@ async def sensors_history_api(limit: int = 100):
 # ------------------- Images -------------------
 @app.post("/api/images")
 async def images_post(image: UploadFile | None = File(None)):
-    global latest_frame_bytes
+    global latest_frame_bytes, latest_frame_id
     if image is None:
         return JSONResponse({"error": "No image sent"}, 400)
 
@@ -100,6 +150,7 @@ async def images_post(image: UploadFile | None = File(None)):
     with open(path, "wb") as f:
         f.write(img_bytes)
     latest_frame_bytes = img_bytes
+    latest_frame_id = fname
 
     # Upload to ImgBB
     imgbb_url = upload_to_imgbb(path)
@@ -116,24 +167,60 @@ async def images_post(image: UploadFile | None = File(None)):
     return {"status": "ok", "filename": fname, "url": imgbb_url}
 
 @app.get("/api/images/latest.jpg")
-async def images_latest():
+async def images_latest(size: str = "full", quality: str = "full"):
+    error = tier_error(size, quality)
+    if error:
+        return error
     files = [f for f in os.listdir("uploads") if f.lower().endswith(".jpg")]
     if files:
         newest = max(files, key=lambda f: os.path.getmtime(os.path.join("uploads", f)))
-        return FileResponse(os.path.join("uploads", newest), media_type="image/jpeg")
+        path = os.path.join("uploads", newest)
+        if SIZE_TIERS[size] is None and QUALITY_TIERS[quality] is None:
+            return FileResponse(path, media_type="image/jpeg")
+
+        def load():
+            with open(path, "rb") as f:
+                return f.read()
+        return Response(await get_tier_bytes(newest, load, size, quality), media_type="image/jpeg")
     if latest_frame_bytes:
-        return Response(latest_frame_bytes, media_type="image/jpeg")
+        frame_bytes = latest_frame_bytes
+        jpeg = await get_tier_bytes(latest_frame_id, lambda: frame_bytes, size, quality)
+        return Response(jpeg, media_type="image/jpeg")
     return JSONResponse({"message": "no image yet"})
 
 # ------------------- MJPEG Stream -------------------
+STREAM_MIN_INTERVAL = 0.05  # seconds between frames for a healthy client (~20 fps)
+STREAM_MAX_INTERVAL = 2.0   # slowest rate an adaptive stream backs off to
+
 @app.get("/api/stream")
-async def mjpeg_stream():
+async def mjpeg_stream(size: str = "full", quality: str = "full", adaptive: bool = True):
+    error = tier_error(size, quality)
+    if error:
+        return error
+
     async def gen():
         boundary = b"--frame"
+        interval = STREAM_MIN_INTERVAL
+        sent_id = None
+        # Each part ends with the next boundary so clients render a frame as soon as it is written
+        yield boundary + b"\r\n"
         while True:
-            await asyncio.sleep(0.05)
-            if latest_frame_bytes:
-                yield boundary + b"\r\nContent-Type: image/jpeg\r\n\r\n" + latest_frame_bytes + b"\r\n"
+            await asyncio.sleep(interval)
+            frame_id, frame_bytes = latest_frame_id, latest_frame_bytes
+            if not frame_bytes or frame_id == sent_id:
+                continue
+            jpeg = await get_tier_bytes(frame_id, lambda b=frame_bytes: b, size, quality)
+            started = time.monotonic()
+            yield (b"Content-Type: image/jpeg\r\nContent-Length: "
+                   + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n" + boundary + b"\r\n")
+            sent_id = frame_id
+            if adaptive:
+                # The yield only resumes once the server has written the part, so a slow
+                # resume means the client's socket is backing up: halve the frame rate
+                if time.monotonic() - started > interval:
+                    interval = min(STREAM_MAX_INTERVAL, interval * 2)
+                else:
+                    interval = max(STREAM_MIN_INTERVAL, interval * 0.9)
     return StreamingResponse(gen(), media_type="multipart/x-mixed-replace; boundary=frame")
 
 # ------------------- Control -------------------
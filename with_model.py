@@ -1,15 +1,19 @@
 import os, time, asyncio
 from datetime import datetime, timezone
-from collections import deque
+from collections import deque, OrderedDict
+from io import BytesIO
 from typing import Optional
-from fastapi import FastAPI, UploadFile, File, Request, Body
+from fastapi import FastAPI, UploadFile, File, Form, Request, Body
 from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pymongo import MongoClient
 from dotenv import load_dotenv
 import requests
+from PIL import Image
 from ultralytics import YOLO
 import torch
+import numpy as np
+import cv2
 # ---------- Load environment variables ----------
 load_dotenv()
 IMGBB_API_KEY = os.environ.get("IMGBB_API_KEY")
@@ -32,6 +36,7 @@ sensors_col = db["sensors"]
 images_col = db["images"]
 control_col = db["control"]
 telemetry_col = db["telemetry"]
+weed_events_col = db["weed_events"]
 
 # ---------- FastAPI Init ----------
 app = FastAPI()
@@ -50,55 +55,162 @@ app.add_middleware(
 SENSOR_HISTORY_MAX = 5000
 sensor_history = deque(maxlen=SENSOR_HISTORY_MAX)
 latest_frame_bytes: Optional[bytes] = None
+latest_frame_id: Optional[str] = None
 latest_annotated_path: Optional[str] = None
 latest_control = {"cmd": "stop", "speed": 150, "timestamp": datetime.now(timezone.utc).isoformat()}
 latest_infer = {"available": False, "timestamp": None, "boxes": [], "score": None, "fname": None}
-
-
-
+weed_trackers = {}  # rover_id -> WeedTracker
+
+
+
+
+# ------------------- Weed Tracking -------------------
+# Define which classes are considered "weed"
+WEED_CLASSES = {"weed", "clover", "dandelion", "crabgrass", "thistle"}
+TRACK_IOU_MIN = 0.3       # IoU needed to continue a track
+TRACK_CENTROID_MAX = 0.5  # fallback: centroid shift as a fraction of the track's box diagonal
+TRACK_CONFIRM_HITS = 3    # frames a track must be seen before it becomes a weed event
+TRACK_MAX_MISSES = 5      # frames a track survives without a match
+
+def iou_matrix(a, b):
+    """Pairwise IoU between (N, 4) and (M, 4) xyxy boxes."""
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+class WeedTracker:
+    """IoU/centroid tracker for one rover's camera; each confirmed track is one weed event."""
+
+    def __init__(self):
+        self.tracks = []
+        self.next_id = 1
+
+    def match_scores(self, boxes, classes):
+        track_boxes = np.array([t["box"] for t in self.tracks])
+        iou = iou_matrix(track_boxes, boxes)
+        track_c = (track_boxes[:, :2] + track_boxes[:, 2:]) / 2
+        det_c = (boxes[:, :2] + boxes[:, 2:]) / 2
+        diag = np.linalg.norm(track_boxes[:, 2:] - track_boxes[:, :2], axis=1)
+        shift = np.linalg.norm(track_c[:, None] - det_c[None], axis=2) / np.maximum(diag[:, None], 1e-9)
+        # IoU matches always outrank centroid-only matches, which score below TRACK_IOU_MIN
+        centroid_score = np.clip(1 - shift / TRACK_CENTROID_MAX, 0, None) * TRACK_IOU_MIN
+        scores = np.where(iou >= TRACK_IOU_MIN, iou, centroid_score)
+        same_class = np.array([t["class"] for t in self.tracks])[:, None] == np.array(classes)[None, :]
+        return np.where(same_class, scores, 0.0)
+
+    def update(self, boxes, classes):
+        """Match this frame's (N, 4) boxes to tracks; return (track id per box, events ready to report).
+
+        Events keep being returned on later frames until confirm() is called for their tracks.
+        """
+        track_ids = [None] * len(boxes)
+        matched = set()
+        if self.tracks and len(boxes):
+            scores = self.match_scores(boxes, classes)
+            # Greedy assignment, best pair first
+            while True:
+                t, d = np.unravel_index(np.argmax(scores), scores.shape)
+                if scores[t, d] <= 0:
+                    break
+                track = self.tracks[t]
+                track.update(box=boxes[d], hits=track["hits"] + 1, misses=0)
+                track_ids[d] = track["id"]
+                matched.add(t)
+                scores[t, :] = 0
+                scores[:, d] = 0
+
+        for i, track in enumerate(self.tracks):
+            if i not in matched:
+                track["misses"] += 1
+        self.tracks = [t for t in self.tracks if t["misses"] <= TRACK_MAX_MISSES]
+
+        for d, track_id in enumerate(track_ids):
+            if track_id is None:
+                track_ids[d] = self.next_id
+                self.tracks.append({"id": self.next_id, "class": classes[d], "box": boxes[d],
+                                    "hits": 1, "misses": 0, "confirmed": False,
+                                    "first_seen": datetime.utcnow().isoformat()})
+                self.next_id += 1
+
+        events = []
+        for track in self.tracks:
+            if not track["confirmed"] and track["hits"] >= TRACK_CONFIRM_HITS:
+                events.append({"track_id": track["id"], "class": track["class"],
+                               "box": track["box"].tolist(), "frames": track["hits"],
+                               "first_seen": track["first_seen"]})
+        return track_ids, events
+
+    def confirm(self, track_ids):
+        """Mark tracks as reported once their events have been persisted."""
+        for track in self.tracks:
+            if track["id"] in track_ids:
+                track["confirmed"] = True
 
 # ------------------- Weed Inference -------------------
 @app.post("/api/infer/weed")
-async def infer_weed_simple(image: UploadFile = File(...)):
+async def infer_weed_simple(image: UploadFile = File(...), rover_id: Optional[str] = Form(None)):
     try:
         if not image:
             return JSONResponse({"error": "No image sent"}, 400)
 
-        # Save uploaded image
+        # Decode in memory; nothing is written unless the frame produces output
         img_bytes = await image.read()
-        fname = f"frame_{int(time.time()*1000)}.jpg"
-        path = os.path.join("uploads", fname)
-        with open(path, "wb") as f:
-            f.write(img_bytes)
+        frame = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            return JSONResponse({"error": "Could not decode image"}, 400)
 
         # Run YOLOv8 inference
-        results = yolo_model(path)
-        weed_detected = False
-
-        # Define which classes are considered "weed"
-        WEED_CLASSES = {"weed", "clover", "dandelion", "crabgrass", "thistle"}
+        results = yolo_model(frame)
 
         detected_classes = []
+        weed_boxes, weed_classes = [], []
         for r in results:
             if r.boxes:
                 class_ids = r.boxes.cls.cpu().numpy().tolist()
-                for cls_id in class_ids:
+                xyxy = r.boxes.xyxy.cpu().numpy()
+                for cls_id, box in zip(class_ids, xyxy):
                     cls_name = r.names[int(cls_id)].lower()
                     detected_classes.append(cls_name)
                     if cls_name in WEED_CLASSES:
-                        weed_detected = True
-
-        # Optionally save annotated image
-        import cv2
-        annotated_img = results[0].plot()
-        annotated_path = f"uploads/annotated_{fname}"
-        cv2.imwrite(annotated_path, annotated_img)
-        img_url = upload_to_imgbb(annotated_path)
+                        weed_boxes.append(box)
+                        weed_classes.append(cls_name)
+        weed_detected = bool(weed_classes)
+
+        # Rovers are tracked so a weed seen over many frames is reported once;
+        # untracked callers (e.g. the test page) still get every frame annotated
+        track_ids, events = [], []
+        if rover_id:
+            tracker = weed_trackers.setdefault(rover_id, WeedTracker())
+            track_ids, events = tracker.update(np.array(weed_boxes, dtype=float).reshape(-1, 4), weed_classes)
+
+        img_url = None
+        if events or not rover_id:
+            fname = f"frame_{int(time.time()*1000)}.jpg"
+            annotated_path = f"uploads/annotated_{fname}"
+            cv2.imwrite(annotated_path, results[0].plot())
+            img_url = upload_to_imgbb(annotated_path)
+
+        if events:
+            now = datetime.utcnow().isoformat()
+            weed_events_col.insert_many([
+                {**e, "rover_id": rover_id, "image_url": img_url, "timestamp": now} for e in events
+            ])
+            # Only now stop reporting these tracks; a failure above leaves them to retry next frame
+            tracker.confirm({e["track_id"] for e in events})
 
         return {
             "status": "ok",
             "weed_detected": weed_detected,
             "detected_classes": detected_classes,  # show what model saw
+            "rover_id": rover_id,
+            "track_ids": track_ids,  # one per weed box, in detection order
+            "events": events,  # tracks reported on this frame
             "image_url": img_url
         }
 
@@ -122,6 +234,53 @@ def upload_to_imgbb(img_path, expiration=None):
     print("ImgBB upload failed:", response.text)
     return None
 
+# ------------------- Viewer Tiers -------------------
+# Longest edge in pixels / JPEG quality; "full" passes the camera JPEG through untouched
+SIZE_TIERS = {"full": None, "high": 1280, "medium": 640, "low": 320}
+QUALITY_TIERS = {"full": None, "high": 85, "medium": 70, "low": 50}
+REENCODE_QUALITY = 90  # used when only the size is reduced
+TIER_CACHE_FRAMES = 4  # recent frame ids kept in the tier cache
+tier_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+def tier_error(size, quality):
+    if size in SIZE_TIERS and quality in QUALITY_TIERS:
+        return None
+    return JSONResponse({"error": "invalid tier",
+                         "sizes": list(SIZE_TIERS),
+                         "qualities": list(QUALITY_TIERS)}, 400)
+
+def encode_tier(img_bytes, max_edge, quality):
+    img = Image.open(BytesIO(img_bytes))
+    if max_edge:
+        img.thumbnail((max_edge, max_edge))  # uses JPEG draft mode to decode at reduced scale
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    out = BytesIO()
+    img.save(out, format="JPEG", quality=quality or REENCODE_QUALITY, optimize=True)
+    return out.getvalue()
+
+async def get_tier_bytes(frame_id, load, size, quality):
+    """Return the frame encoded for a tier, encoding it at most once per frame id."""
+    max_edge, q = SIZE_TIERS[size], QUALITY_TIERS[quality]
+    if max_edge is None and q is None:
+        return load()
+    tiers = tier_cache.get(frame_id)
+    if tiers is None:
+        tiers = tier_cache[frame_id] = {}
+        while len(tier_cache) > TIER_CACHE_FRAMES:
+            tier_cache.popitem(last=False)
+    task = tiers.get((size, quality))
+    if task is None:
+        # Concurrent viewers of the same tier all await this one encode
+        task = asyncio.ensure_future(asyncio.to_thread(lambda: encode_tier(load(), max_edge, q)))
+        tiers[(size, quality)] = task
+    try:
+        # Shielded so one viewer disconnecting does not cancel the encode for the others
+        return await asyncio.shield(task)
+    except Exception as e:
+        print("Tier encode failed:", e)
+        return load()
+
 # ------------------- Sensors -------------------
 @app.post("/api/sensors")
 async def sensors_post(data: dict):
@@ -148,7 +307,7 @@ async def sensors_history_api(limit: int = 100):
 # ------------------- Images -------------------
 @app.post("/api/images")
 async def images_post(image: UploadFile | None = File(None)):
-    global latest_frame_bytes
+    global latest_frame_bytes, latest_frame_id
     if image is None:
         return JSONResponse({"error": "No image sent"}, 400)
 
@@ -158,6 +317,7 @@ async def images_post(image: UploadFile | None = File(None)):
     with open(path, "wb") as f:
         f.write(img_bytes)
     latest_frame_bytes = img_bytes
+    latest_frame_id = fname
 
     # Upload to ImgBB
     imgbb_url = upload_to_imgbb(path)
@@ -174,24 +334,60 @@ async def images_post(image: UploadFile | None = File(None)):
     return {"status": "ok", "filename": fname, "url": imgbb_url}
 
 @app.get("/api/images/latest.jpg")
-async def images_latest():
+async def images_latest(size: str = "full", quality: str = "full"):
+    error = tier_error(size, quality)
+    if error:
+        return error
     files = [f for f in os.listdir("uploads") if f.lower().endswith(".jpg")]
     if files:
         newest = max(files, key=lambda f: os.path.getmtime(os.path.join("uploads", f)))
-        return FileResponse(os.path.join("uploads", newest), media_type="image/jpeg")
+        path = os.path.join("uploads", newest)
+        if SIZE_TIERS[size] is None and QUALITY_TIERS[quality] is None:
+            return FileResponse(path, media_type="image/jpeg")
+
+        def load():
+            with open(path, "rb") as f:
+                return f.read()
+        return Response(await get_tier_bytes(newest, load, size, quality), media_type="image/jpeg")
     if latest_frame_bytes:
-        return Response(latest_frame_bytes, media_type="image/jpeg")
+        frame_bytes = latest_frame_bytes
+        jpeg = await get_tier_bytes(latest_frame_id, lambda: frame_bytes, size, quality)
+        return Response(jpeg, media_type="image/jpeg")
     return JSONResponse({"message": "no image yet"})
 
 # ------------------- MJPEG Stream -------------------
+STREAM_MIN_INTERVAL = 0.05  # seconds between frames for a healthy client (~20 fps)
+STREAM_MAX_INTERVAL = 2.0   # slowest rate an adaptive stream backs off to
+
 @app.get("/api/stream")
-async def mjpeg_stream():
+async def mjpeg_stream(size: str = "full", quality: str = "full", adaptive: bool = True):
+    error = tier_error(size, quality)
+    if error:
+        return error
+
     async def gen():
         boundary = b"--frame"
+        interval = STREAM_MIN_INTERVAL
+        sent_id = None
+        # Each part ends with the next boundary so clients render a frame as soon as it is written
+        yield boundary + b"\r\n"
         while True:
-            await asyncio.sleep(0.05)
-            if latest_frame_bytes:
-                yield boundary + b"\r\nContent-Type: image/jpeg\r\n\r\n" + latest_frame_bytes + b"\r\n"
+            await asyncio.sleep(interval)
+            frame_id, frame_bytes = latest_frame_id, latest_frame_bytes
+            if not frame_bytes or frame_id == sent_id:
+                continue
+            jpeg = await get_tier_bytes(frame_id, lambda b=frame_bytes: b, size, quality)
+            started = time.monotonic()
+            yield (b"Content-Type: image/jpeg\r\nContent-Length: "
+                   + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n" + boundary + b"\r\n")
+            sent_id = frame_id
+            if adaptive:
+                # The yield only resumes once the server has written the part, so a slow
+                # resume means the client's socket is backing up: halve the frame rate
+                if time.monotonic() - started > interval:
+                    interval = min(STREAM_MAX_INTERVAL, interval * 2)
+                else:
+                    interval = max(STREAM_MIN_INTERVAL, interval * 0.9)
     return StreamingResponse(gen(), media_type="multipart/x-mixed-replace; boundary=frame")
 
 # ------------------- Control -------------------